@@ -1,9 +1,43 @@
-import os
-import tempfile
-
+import numpy as np
+import pandas as pd
 import streamlit as st
 
-from main import map_kor_measurements, parse_kor_measurements
+from main import map_kor_measurements, parse_kor_measurements, update_kor_map
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_cached(file_bytes: bytes) -> tuple[pd.DataFrame, pd.Series | None]:
+    """Parse uploaded file contents, reusing the result across reruns.
+
+    Also returns midnight of each measurement's day for the date filters,
+    or None when the data has no Activity_Date_Time column.
+    """
+    df = parse_kor_measurements(file_bytes)
+    if "Activity_Date_Time" not in df.columns:
+        return df, None
+    return df, df["Activity_Date_Time"].dt.normalize()
+
+
+def _session_map(df: pd.DataFrame, file_id: str, filter_key: tuple, title: str):
+    """Return the session's map figure, showing the rows for this filter.
+
+    The figure is rebuilt only for a new upload or a different set of
+    sensors; other filter changes swap the trace data in place.
+    """
+    map_key = (file_id, filter_key)
+    previous_key = st.session_state.get("map_key")
+
+    if previous_key != map_key:
+        if (
+            previous_key is None
+            or previous_key[0] != file_id
+            or not update_kor_map(st.session_state.map_fig, df)
+        ):
+            st.session_state.map_fig = map_kor_measurements(df, title)
+        st.session_state.map_key = map_key
+
+    return st.session_state.map_fig
+
 
 # Set page config
 st.set_page_config(page_title="Kor File Viewer", page_icon="📊", layout="wide")
@@ -19,17 +53,9 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     try:
-        # Create a temporary file to save the uploaded content
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-
         # Parse the file using the existing function
         with st.spinner("Parsing Kor measurements..."):
-            df = parse_kor_measurements(tmp_file_path)
-
-        # Clean up the temporary file
-        os.unlink(tmp_file_path)
+            df, activity_dates = _parse_cached(uploaded_file.getvalue())
 
         if not df.empty:
             st.success(f"✅ Successfully parsed {len(df)} measurements!")
@@ -49,7 +75,9 @@ if uploaded_file is not None:
                     horizontal=True,
                 )
 
-                filtered_df = df.copy()
+                filtered_df = df
+                # Identifies the rows in filtered_df for the map cache
+                filter_key = ()
 
                 if filter_type == "Single Date":
                     selected_date = st.date_input(
@@ -62,9 +90,8 @@ if uploaded_file is not None:
 
                     if selected_date:
                         # Filter for the selected date
-                        filtered_df = df[
-                            df["Activity_Date_Time"].dt.date == selected_date
-                        ]
+                        filtered_df = df[activity_dates == pd.Timestamp(selected_date)]
+                        filter_key = (selected_date,)
 
                 elif filter_type == "Date Range":
                     col1, col2 = st.columns(2)
@@ -90,9 +117,11 @@ if uploaded_file is not None:
                     if start_date and end_date and start_date <= end_date:
                         # Filter for the date range
                         filtered_df = df[
-                            (df["Activity_Date_Time"].dt.date >= start_date)
-                            & (df["Activity_Date_Time"].dt.date <= end_date)
+                            activity_dates.between(
+                                pd.Timestamp(start_date), pd.Timestamp(end_date)
+                            )
                         ]
+                        filter_key = (start_date, end_date)
                     elif start_date and end_date and start_date > end_date:
                         st.error("⚠️ Start date must be before or equal to end date.")
                         filtered_df = df  # Show all data if invalid range
@@ -106,9 +135,11 @@ if uploaded_file is not None:
                     if len(filtered_df) == 0:
                         st.warning("⚠️ No measurements found for the selected date(s).")
                         filtered_df = df  # Show all data if no results
+                        filter_key = ()
             else:
                 st.warning("⚠️ No Activity_Date_Time column found in the data.")
                 filtered_df = df
+                filter_key = ()
 
             # Display dataframe
             st.subheader("📋 Measurement Data")
@@ -122,7 +153,16 @@ if uploaded_file is not None:
                 st.metric("Total Measurements", len(filtered_df))
 
             with col2:
-                st.metric("Unique Sensors", filtered_df["SERIAL_NUMBER"].nunique())
+                serial_numbers = filtered_df["SERIAL_NUMBER"]
+                # Every category occurs in the unfiltered data, so the category
+                # count is the answer; date filters keep unused categories
+                if filtered_df is df and isinstance(
+                    serial_numbers.dtype, pd.CategoricalDtype
+                ):
+                    unique_sensors = serial_numbers.cat.categories.size
+                else:
+                    unique_sensors = serial_numbers.nunique()
+                st.metric("Unique Sensors", unique_sensors)
 
             with col3:
                 st.metric("Unique Sites", filtered_df["SITE_NAME"].nunique())
@@ -133,14 +173,19 @@ if uploaded_file is not None:
             # Check if we have location data
             if "Latitude" in filtered_df.columns and "Longitude" in filtered_df.columns:
                 # Filter out rows without valid coordinates and coordinates with value 0
-                df_with_coords = filtered_df.dropna(subset=["Latitude", "Longitude"])
-                df_with_coords = df_with_coords[
-                    (df_with_coords["Latitude"] != 0)
-                    & (df_with_coords["Longitude"] != 0)
-                ]
+                # in a single mask over the coordinate arrays
+                lat = filtered_df["Latitude"].to_numpy()
+                lon = filtered_df["Longitude"].to_numpy()
+                has_coords = ~(np.isnan(lat) | np.isnan(lon) | (lat == 0) | (lon == 0))
+                df_with_coords = filtered_df[has_coords]
 
                 if not df_with_coords.empty:
-                    fig = map_kor_measurements(df_with_coords, "Kor Measurements Map")
+                    fig = _session_map(
+                        df_with_coords,
+                        uploaded_file.file_id,
+                        filter_key,
+                        "Kor Measurements Map",
+                    )
                     st.plotly_chart(
                         fig,
                         use_container_width=True,
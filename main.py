@@ -1,7 +1,38 @@
+import codecs
+import functools
 import io
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+# Summary and file preamble lines that never hold measurements
+_SKIP_PREFIXES = (
+    "MEAN VALUE:",
+    "STANDARD DEVIATION:",
+    "sep=",
+    "Kor MEASUREMENT",
+    "FILE CREATED:",
+)
+
+# Line classes assigned by classify_lines
+LINE_SKIP, LINE_SERIAL, LINE_HEADER, LINE_DATA = range(4)
+
+# Columns shown when hovering over a point on the map, in customdata order
+MAP_HOVER_COLUMNS = [
+    "SERIAL_NUMBER",
+    "SITE_NAME",
+    "DEPTH_M",
+    "Activity_Date_Time",
+    "TEMP_°C",
+    "ODO_%_SAT",
+    "ODO_MG/L",
+    "TURBIDITY_FNU",
+    "SAL_PSU",
+    "PH",
+]
 
 
 def rename_columns(col):
@@ -17,13 +48,76 @@ def rename_columns(col):
         return col.replace(" ", "_")
 
 
+@functools.cache
+def column_renames(columns: tuple[str, ...]) -> dict[str, str]:
+    # Exports from the same instrument share a header, so reuse the mapping
+    return {col: rename_columns(col) for col in columns}
+
+
+@functools.cache
+def block_column_names(header_row: str) -> tuple[str, ...]:
+    # Let the C engine name the columns so that a repeated name such as PH
+    # becomes PH.1 and blank names become Unnamed: N, whichever engine then
+    # reads the block, instead of pyarrow keeping the duplicates as they are
+    return tuple(pd.read_csv(io.StringIO(header_row), nrows=0).columns)
+
+
+def read_block_csv(headers: str, data_lines: pd.Series) -> pd.DataFrame:
+    # Create CSV data with the serial number column prepended
+    header_row = f"SERIAL_NUMBER,{headers}"
+    csv_text = f"{header_row}\n" + data_lines.str.cat(sep="\n")
+    column_names = block_column_names(header_row)
+
+    # Keep serial numbers, dates and times as text so they are not
+    # inferred as numbers or datetime.time objects
+    text_columns = [
+        col
+        for col in column_names
+        if col == "SERIAL_NUMBER" or col.startswith(("DATE ", "TIME "))
+    ]
+
+    try:
+        table = pa_csv.read_csv(
+            io.BytesIO(csv_text.encode()),
+            read_options=pa_csv.ReadOptions(column_names=column_names, skip_rows=1),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={col: pa.string() for col in text_columns},
+                strings_can_be_null=True,
+            ),
+        )
+        # Columns with no values at all are read as float like the C engine
+        # does, rather than as objects that upcast other blocks on concat
+        table = table.cast(
+            pa.schema(
+                pa.field(field.name, pa.float64())
+                if pa.types.is_null(field.type)
+                else field
+                for field in table.schema
+            )
+        )
+        block_df = table.to_pandas()
+    except pa.ArrowInvalid:
+        # Fall back to the C engine, which is more forgiving of irregular rows
+        block_df = pd.read_csv(
+            io.StringIO(csv_text), engine="c", dtype=dict.fromkeys(text_columns, str)
+        )
+
+    # Index rows by their line numbers so that file order can be restored
+    block_df.index = data_lines.index
+    return block_df
+
+
 def clean_kor_measurements(df: pd.DataFrame) -> pd.DataFrame:
     return (
-        df.rename(columns=rename_columns)
+        df.rename(columns=column_renames(tuple(df.columns)))
         .query("SERIAL_NUMBER != 'TBD'")
         .assign(
-            Activity_Date_Time=lambda x: pd.to_datetime(x.Date + " " + x.Time),
-            # Activity_Date=lambda df_: pd.to_datetime(df_["Date"], format="%m/%d/%Y"),
+            # Dates repeat heavily, so parse them once each through the cache
+            # and add the times as offsets instead of parsing combined strings
+            Activity_Date_Time=lambda x: (
+                pd.to_datetime(x.Date, format="%m/%d/%Y", cache=True)
+                + pd.to_timedelta(x.Time)
+            ),
         )
         .drop(columns=["Date", "Time"])
         .astype(
@@ -31,6 +125,12 @@ def clean_kor_measurements(df: pd.DataFrame) -> pd.DataFrame:
                 "SERIAL_NUMBER": "category",
             }
         )
+        # Single precision is ample for display and about 1 m for coordinates
+        .pipe(
+            lambda df_: df_.astype(
+                {col: "float32" for col in df_.select_dtypes("float64").columns}
+            )
+        )
         .assign(SITE_NAME=lambda x: x["SITE_NAME"].astype("string"))
         .pipe(
             lambda df_: df_.reindex(
@@ -49,135 +149,222 @@ def clean_kor_measurements(df: pd.DataFrame) -> pd.DataFrame:
     )
 
 
-def parse_kor_measurements(file_path):
+def classify_lines(lines: pd.Series) -> np.ndarray:
+    """
+    Tag each stripped export line with its line class.
+
+    Returns an int8 array holding LINE_SERIAL for sensor serial number lines,
+    LINE_HEADER for column header lines, LINE_DATA for lines shaped like
+    measurement rows and LINE_SKIP for everything else.
+    """
+    is_serial = lines.str.startswith("SENSOR SERIAL NUMBER:")
+    is_header = lines.str.contains("TIME (HH:MM:SS)", regex=False)
+    # Measurement rows have more than 9 comma separated fields
+    is_data = ~lines.str.startswith(_SKIP_PREFIXES) & lines.str.contains(
+        r"^(?:[^,]*,){9}", regex=True
+    )
+
+    return np.select(
+        [is_serial.to_numpy(bool), is_header.to_numpy(bool), is_data.to_numpy(bool)],
+        [LINE_SERIAL, LINE_HEADER, LINE_DATA],
+        LINE_SKIP,
+    ).astype(np.int8)
+
+
+def read_head(source, size: int = 4096) -> bytes:
+    if isinstance(source, io.IOBase):
+        # Peek at the stream and rewind it for the actual read
+        position = source.tell()
+        head = source.read(size)
+        source.seek(position)
+        return head
+
+    with open(source, "rb") as f:
+        return f.read(size)
+
+
+def detect_encoding(source) -> str:
+    head = read_head(source)
+
+    # Kor exports are UTF-16 with a byte order mark
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+
+    # Other text files never contain NUL bytes, so without a byte order mark
+    # their position gives away the UTF-16 byte order
+    if b"\x00" in head:
+        return "utf-16-be" if head.startswith(b"\x00") else "utf-16-le"
+
+    return "latin-1"
+
+
+def parse_kor_measurements(source):
     """
     Parse Kor measurement export file into a pandas DataFrame.
 
     Parameters:
     -----------
-    file_path : str
-        Path to the Kor measurement export CSV file
+    source : str, bytes or binary file object
+        Path to the Kor measurement export CSV file, its raw contents, or a
+        binary file object positioned at the start of the export
 
     Returns:
     --------
     pandas.DataFrame
         Cleaned measurement data with appropriate columns and serial numbers
     """
-    encodings = ["utf-16", "latin-1", "cp1252"]
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    # A file holding at most a byte order mark has no lines for Arrow to read
+    if read_head(source, 3) in (b"", codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        return pd.DataFrame()  # Return empty DataFrame for an empty file
+
+    def skip_split_line(row):
+        print(f"Warning: Skipping line with a unit separator: {row.text[:80]!r}")
+        return "skip"
+
+    # Stream the file into Arrow as one text field per line: Kor exports do
+    # not use the unit separator, so only a stray one can split a line
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(
+            column_names=["raw"], encoding=detect_encoding(source)
+        ),
+        parse_options=pa_csv.ParseOptions(
+            delimiter="\x1f", quote_char=False, invalid_row_handler=skip_split_line
+        ),
+        convert_options=pa_csv.ConvertOptions(column_types={"raw": pa.string()}),
+    )
 
-    for encoding in encodings:
-        try:
-            with open(file_path, "r", encoding=encoding) as f:
-                lines = f.readlines()
-            break
-        except UnicodeError:
-            continue
-    else:
-        raise ValueError(f"Could not read file with any of the encodings: {encodings}")
-
-    all_data_blocks = []
-    current_block = {"serial": None, "headers": None, "data_lines": []}
-
-    for line in lines:
-        line = line.strip()
-
-        if not line:
-            continue
-
-        if line.startswith(("MEAN VALUE:", "STANDARD DEVIATION:")):
-            continue
-
-        # Start a new block when we encounter a new serial number line
-        if line.startswith("SENSOR SERIAL NUMBER:"):
-            # Save the previous block if it has data
-            if current_block["headers"] and current_block["data_lines"]:
-                all_data_blocks.append(current_block)
-
-            # Start a new block
-            current_block = {"serial": None, "headers": None, "data_lines": []}
-
-            # Parse the serial number
-            fields = line.split(",")
-            # Look for the first non-empty serial number starting from index 4
-            for i in range(4, min(7, len(fields))):
-                if i < len(fields) and fields[i].strip():
-                    current_block["serial"] = fields[i].strip()
-                    break
-            continue
-
-        # Capture headers for current block
-        if "TIME (HH:MM:SS)" in line:
-            current_block["headers"] = line.strip()
-            continue
-
-        # Process data lines for current block
-        if (
-            "," in line
-            and not line.startswith(("sep=", "Kor MEASUREMENT", "FILE CREATED:"))
-            and current_block["serial"] is not None
-        ):
-            data_fields = line.split(",")
-            if len(data_fields) > 9:  # Ensure it's a data line
-                current_block["data_lines"].append(line)
-
-    # Don't forget the last block
-    if current_block["headers"] and current_block["data_lines"]:
-        all_data_blocks.append(current_block)
-
-    # Process each block separately and create DataFrames
-    dataframes = []
+    lines = pd.Series(table.column("raw"), dtype="string[pyarrow]").str.strip()
+    line_classes = classify_lines(lines)
+    is_serial = line_classes == LINE_SERIAL
+
+    # Each serial number line starts a new block
+    block = np.cumsum(is_serial)
 
-    for block in all_data_blocks:
-        if block["headers"] and block["data_lines"]:
-            # Create CSV data for this block
-            block_csv_data = io.StringIO()
+    # Look for the first non-empty serial number from index 4 to 6
+    serial_fields = (
+        lines[is_serial]
+        .str.split(",", n=7, expand=True)
+        .apply(lambda col: col.str.strip())
+        .reindex(columns=range(4, 7))
+    )
+    serial_numbers = serial_fields.where(serial_fields != "").bfill(axis=1)[4]
+
+    # Carry each serial number forward from the line that starts its block
+    last_serial_line = np.maximum.accumulate(
+        np.where(is_serial, np.arange(len(lines)), -1)
+    )
+    serial = (
+        serial_numbers.reindex(last_serial_line)
+        .set_axis(lines.index)
+        .astype("string[pyarrow]")
+    )
 
-            # Add headers with serial number column
-            headers_with_serial = f"SERIAL_NUMBER,{block['headers']}"
-            block_csv_data.write(f"{headers_with_serial}\n")
+    # The last header line seen in a block applies to the whole block
+    headers = lines.where(line_classes == LINE_HEADER).groupby(block).transform("last")
 
-            # Add data lines with serial number
-            for data_line in block["data_lines"]:
-                block_csv_data.write(f"{block['serial']},{data_line}\n")
+    is_data = (line_classes == LINE_DATA) & serial.notna() & headers.notna()
+    data_lines = (serial + "," + lines)[is_data]
 
-            # Reset position for reading
-            block_csv_data.seek(0)
+    dataframes = []
 
-            # Read this block into a DataFrame
-            try:
-                block_df = pd.read_csv(block_csv_data)
-                dataframes.append(block_df)
-            except Exception as e:
-                print(
-                    f"Warning: Could not parse block with serial {block['serial']}: {e}"
-                )
-                continue
+    # Read all blocks that share a header row in one pass
+    for block_headers, header_lines in data_lines.groupby(headers[is_data], sort=False):
+        try:
+            header_df = read_block_csv(block_headers, header_lines)
+        except (pa.ArrowInvalid, pd.errors.ParserError, ValueError):
+            # Read block by block so that only unparseable blocks are skipped
+            for _, block_lines in header_lines.groupby(block[header_lines.index]):
+                try:
+                    dataframes.append(read_block_csv(block_headers, block_lines))
+                except Exception as e:
+                    print(
+                        f"Warning: Could not parse block with serial {serial[block_lines.index[0]]}: {e}"
+                    )
+        else:
+            dataframes.append(header_df)
 
     if dataframes:
-        # Concatenate all DataFrames
-        combined_df = pd.concat(dataframes, ignore_index=True)
+        # Concatenate only when blocks have different headers
+        if len(dataframes) == 1:
+            combined_df = dataframes[0]
+        else:
+            combined_df = pd.concat(dataframes)
+
+        # Groups of blocks with different headers may interleave in the file
+        if not combined_df.index.is_monotonic_increasing:
+            combined_df = combined_df.sort_index()
+
+        # Renumber the rows in place rather than copying via reset_index
+        combined_df.index = pd.RangeIndex(len(combined_df))
         return clean_kor_measurements(combined_df)
 
     return pd.DataFrame()  # Return empty DataFrame if no valid data found
 
 
+def downsample_for_map(df: pd.DataFrame, max_points: int = 10_000) -> pd.DataFrame:
+    """
+    Collapse nearby measurements of each sensor into one averaged point.
+
+    Points are binned on a grid of roughly 100 m cells, which is doubled
+    until at most ``max_points`` remain, or down to one point per sensor if
+    even cells spanning the globe leave too many. Numeric columns are
+    averaged and the remaining columns keep the first value in each cell.
+    """
+    if len(df) <= max_points:
+        return df
+
+    numeric_columns = df.select_dtypes("number").columns
+    aggregations = {
+        col: "mean" if col in numeric_columns else "first"
+        for col in df.columns
+        if col != "SERIAL_NUMBER"
+    }
+
+    # Count the cells at each size and only aggregate at the chosen one
+    cell_size = 1e-3
+    while cell_size < 360:
+        cells = [
+            (df["Latitude"] // cell_size).rename("cell_lat"),
+            (df["Longitude"] // cell_size).rename("cell_lon"),
+            df["SERIAL_NUMBER"],
+        ]
+        cell_ids = df.groupby(cells, observed=True, sort=False).ngroup()
+        if cell_ids.max() + 1 <= max_points:
+            break
+        cell_size *= 2
+    else:
+        # Cells now span the globe, so keep one point per sensor
+        cells = [df["SERIAL_NUMBER"]]
+
+    binned = df.groupby(cells, observed=True, sort=False).agg(aggregations)
+    return binned.reset_index("SERIAL_NUMBER").reset_index(drop=True)
+
+
+def prepare_map_data(df: pd.DataFrame) -> pd.DataFrame:
+    # Bound the number of points serialized to the browser
+    df = downsample_for_map(df)
+
+    # Hover values are sent as JSON text, where float32 values widen to about
+    # 17 digits; two decimals in double precision serialize compactly
+    return df.assign(
+        **{
+            col: df[col].astype("float64").round(2)
+            for col in MAP_HOVER_COLUMNS
+            if df[col].dtype.kind == "f"
+        }
+    )
+
+
 def map_kor_measurements(df: pd.DataFrame, title: str = "Kor Measurements"):
     fig = px.scatter_mapbox(
-        df,
+        prepare_map_data(df),
         lat="Latitude",
         lon="Longitude",
-        hover_data=[
-            "SERIAL_NUMBER",
-            "SITE_NAME",
-            "DEPTH_M",
-            "Activity_Date_Time",
-            "TEMP_°C",
-            "ODO_%_SAT",
-            "ODO_MG/L",
-            "TURBIDITY_FNU",
-            "SAL_PSU",
-            "PH",
-        ],
+        hover_data=MAP_HOVER_COLUMNS,
         color="SERIAL_NUMBER",
         zoom=10,
         mapbox_style="carto-positron",
@@ -191,3 +378,32 @@ def map_kor_measurements(df: pd.DataFrame, title: str = "Kor Measurements"):
     )
 
     return fig
+
+
+def update_kor_map(fig, df: pd.DataFrame) -> bool:
+    """
+    Swap the points of a figure from map_kor_measurements in place.
+
+    Each sensor trace gets the coordinates and hover values of its rows in
+    ``df``, and the map is recentred on them as a new figure would be, keeping
+    the rest of the layout. Returns False, leaving the figure untouched, when
+    ``df`` has a different set of sensors than the figure's traces; build a
+    new figure in that case.
+    """
+    map_df = prepare_map_data(df)
+    sensors = dict(list(map_df.groupby("SERIAL_NUMBER", observed=True, sort=False)))
+    if {trace.name for trace in fig.data} != set(sensors):
+        return False
+
+    with fig.batch_update():
+        fig.layout.mapbox.center = {
+            "lat": map_df["Latitude"].mean(),
+            "lon": map_df["Longitude"].mean(),
+        }
+        for trace in fig.data:
+            sensor_df = sensors[trace.name]
+            trace.lat = sensor_df["Latitude"].to_numpy()
+            trace.lon = sensor_df["Longitude"].to_numpy()
+            trace.customdata = sensor_df[MAP_HOVER_COLUMNS].to_numpy()
+
+    return True